@@ -1,3 +1,4 @@
 API_TOKEN: str = ''
 admin_id: int = 0
 mongourl: str = 'mongodb://{log}:{pass}@{ip}:{port}'
+redisurl: str = 'redis://{ip}:{port}'
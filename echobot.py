@@ -1,33 +1,55 @@
 import asyncio
 import logging
+import logging.handlers
+import queue as queue_module
 import time
-from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Union
 
+import aioredis
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher.filters import Command
 from aiogram.types import ParseMode, BotCommand
-from aiogram.utils.exceptions import BotBlocked, UserDeactivated
+from aiogram.utils.exceptions import BotBlocked, RetryAfter, UserDeactivated
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import InsertOne, ReturnDocument
 from pydantic import BaseModel
 
-from config import API_TOKEN, admin_id, mongourl
+from config import API_TOKEN, admin_id, mongourl, redisurl
 
-logging.basicConfig(level=logging.INFO)
+log_queue = queue_module.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
 
 bot = Bot(token=API_TOKEN, parse_mode=ParseMode.HTML)
 dp = Dispatcher(bot)
 dp.middleware.setup(LoggingMiddleware())
 
-mongo_client = AsyncIOMotorClient(mongourl)
+mongo_client = AsyncIOMotorClient(mongourl, maxPoolSize=500, minPoolSize=50, w=1, journal=False,
+                                  retryWrites=True, compressors="zstd")
 db: AsyncIOMotorDatabase = mongo_client['bot_db']
+redis = aioredis.from_url(redisurl)
+
+cooldown_ms = 60 * 1000
+ban_ms = 365 * 24 * 60 * 60 * 1000
 
 
 commands = {"start": "Старт",
             "settings": "Настройки",
             "del": "Удалить сообщение"}
 
+broadcast_window_size = 100
+broadcast_workers = 32
+broadcast_queue_size = 200
+send_semaphore = asyncio.Semaphore(30)
+
+user_cache_ttl = 30
+user_cache: dict = {}
+
+settings_callbacks = frozenset(["toggle_show_nickname_inline"])
+
 
 class User(BaseModel):
     user_id: int
@@ -36,22 +58,50 @@ class User(BaseModel):
 
 
 async def get_user(user_id: int) -> Union[User, None]:
-    user_data = await db.users.find_one({"user_id": user_id})
+    user_data = await db.users.find_one({"user_id": user_id},
+                                        projection={"user_id": 1, "admin": 1, "vip": 1, "_id": 0})
     if user_data:
-        return User(id=user_data["user_id"], admin=user_data.get("admin"),
+        return User(user_id=user_data["user_id"], admin=user_data.get("admin"),
                     vip=user_data.get("vip"))
     return None
 
 
-async def save_user(user: User, admin: bool = False, vip: bool = False) -> None:
-    await db.users.update_one({"user_id": user.user_id}, {
-        "$set": {"user_id": user.user_id, "admin": admin, "vip": vip}}, upsert=True)
+async def save_user(user_id: int, **fields: bool) -> None:
+    defaults = {"user_id": user_id, "admin": False, "vip": False}
+    for field in fields:
+        defaults.pop(field, None)
+    update = {"$setOnInsert": defaults}
+    if fields:
+        update["$set"] = fields
+    await db.users.update_one({"user_id": user_id}, update, upsert=True)
+    invalidate_user_cache(user_id)
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    user_cache.pop(user_id, None)
+
+
+async def fetch_user_cached(user_id: int) -> dict:
+    cached = user_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    res = await db.users.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$lookup": {"from": "settings", "localField": "user_id", "foreignField": "user_id", "as": "st"}},
+        {"$project": {"admin": {"$ifNull": ["$admin", False]},
+                      "vip": {"$ifNull": ["$vip", False]},
+                      "show_nickname_inline": {
+                          "$ifNull": [{"$arrayElemAt": ["$st.show_nickname_inline", 0]}, False]}}},
+    ]).to_list(1)
+    user_data = res[0] if res else {"admin": False, "vip": False, "show_nickname_inline": False}
+    user_cache[user_id] = (time.monotonic() + user_cache_ttl, user_data)
+    return user_data
 
 
 @dp.message_handler(Command('admin'))
 async def admin_handler(message: types.Message):
     if message.from_user.id == admin_id:
-        await save_user(User(user_id=int(message.get_args())), admin=True)
+        await save_user(int(message.get_args()), admin=True)
         await message.reply('Готово!')
     else:
         await message.reply('У вас нет прав для выполнения этой команды.')
@@ -60,7 +110,7 @@ async def admin_handler(message: types.Message):
 @dp.message_handler(Command('vip'))
 async def vip_handler(message: types.Message):
     if message.from_user.id == admin_id:
-        await save_user(User(user_id=int(message.get_args())), vip=True)
+        await save_user(int(message.get_args()), vip=True)
         await message.reply('Готово!')
     else:
         await message.reply('У вас нет прав для выполнения этой команды.')
@@ -71,43 +121,22 @@ async def is_admin(user_id: int) -> bool:
     return user_data["admin"] if user_data else False
 
 
-async def is_vip(user_id: int) -> bool:
-    user_data = await db.users.find_one({"user_id": user_id})
-    return user_data["vip"] if user_data else False
-
-
 async def get_settings(user_id: int) -> dict:
-    settings = await db.settings.find_one({"user_id": user_id})
-    if settings is None:
-        default_settings = {
-            "user_id": user_id,
-            "show_nickname_inline": False,
-        }
-        await db.settings.insert_one(default_settings)
-        return default_settings
-    return settings
+    return await db.settings.find_one_and_update(
+        {"user_id": user_id},
+        {"$setOnInsert": {"user_id": user_id, "show_nickname_inline": False}},
+        upsert=True, return_document=ReturnDocument.AFTER)
 
 
 async def update_settings(user_id: int, field: str, value: bool) -> None:
     await db.settings.update_one({"user_id": user_id}, {"$set": {field: value}})
-
-
-async def cooldown_check(user_id: int) -> bool:
-    last_message = await db.cooldown.find_one({"user_id": user_id})
-    if last_message:
-        if (datetime.now() - last_message["sent_at"]).total_seconds() < 60:
-            return False
-    return True
-
-
-async def update_cooldown(user_id: int) -> None:
-    await db.cooldown.update_one({"user_id": user_id}, {"$set": {"sent_at": datetime.now()}}, upsert=True)
+    invalidate_user_cache(user_id)
 
 
 @dp.message_handler(Command('start'))
 async def start_handler(message: types.Message):
     if not await db.users.find_one({"user_id": message.from_user.id}):
-        await save_user(User(user_id=message.from_user.id))
+        await save_user(message.from_user.id)
     await message.reply('Привет! Добро пожаловать в наш бот.')
 
 
@@ -123,13 +152,13 @@ async def settings_handler(message: types.Message):
     await message.reply('Настройки отображения:', reply_markup=reply_markup)
 
 
-@dp.callback_query_handler(lambda query: query.data in ["toggle_show_nickname_inline"])
+@dp.callback_query_handler(lambda query: query.data in settings_callbacks)
 async def settings_callback_handler(query: types.CallbackQuery):
     setting_to_toggle = query.data[7:]
-    current_setting = (await get_settings(query.from_user.id))[setting_to_toggle]
-    await update_settings(query.from_user.id, setting_to_toggle, not current_setting)
-
     settings = await get_settings(query.from_user.id)
+    await update_settings(query.from_user.id, setting_to_toggle, not settings[setting_to_toggle])
+
+    settings[setting_to_toggle] = not settings[setting_to_toggle]
     inline_btn_show_nickname_inline = types.InlineKeyboardButton(
         'Показывать никнейм: ' + ("✅" if settings["show_nickname_inline"] else "❌"),
         callback_data="toggle_show_nickname_inline"
@@ -140,153 +169,175 @@ async def settings_callback_handler(query: types.CallbackQuery):
     await query.answer('Настройка обновлена.')
 
 
-async def save_sent_message(sender_id: int, sender_message_id: int, receiver_id: int, receiver_message_id: int,
-                            original_message_id: int) -> None:
-    await db.sent_messages.insert_one(
-        {"sender_id": sender_id, "sender_message_id": sender_message_id, "receiver_id": receiver_id,
-         "receiver_message_id": receiver_message_id, "original_message_id": original_message_id})
-
-
 async def get_sent_messages(sender_id: int, sender_message_id: int) -> list:
-    return await db.sent_messages.find({"sender_id": sender_id, "original_message_id": sender_message_id}
+    return await db.sent_messages.find({"sender_id": sender_id, "original_message_id": sender_message_id},
+                                       projection={"receiver_id": 1, "receiver_message_id": 1, "_id": 0}
                                        ).to_list(length=10000)
 
 
-async def get_sent_message_id(sender_message_id: int = None, original_message_id: int = None,
-                              receiver_id: int = None):
-    if sender_message_id:
-        if receiver_id:
-            sent_message = await db.sent_messages.find_one(
-                {"sender_message_id": sender_message_id, "receiver_id": receiver_id}
-            )
-            if sent_message:
-                return sent_message["receiver_message_id"]
-        else:
-            sent_message = await db.sent_messages.find_one(
-                {"sender_message_id": sender_message_id}
-            )
-            if sent_message:
-                return sent_message
-    elif original_message_id:
-        if receiver_id:
-            sent_message = await db.sent_messages.find_one(
-                {"receiver_id": receiver_id, "original_message_id": original_message_id}
-            )
-            if sent_message:
-                return sent_message["receiver_message_id"]
-        else:
-            sent_message = await db.sent_messages.find_one(
-                {"original_message_id": original_message_id}
-            )
-            if sent_message:
-                return sent_message
+@lru_cache(maxsize=4096)
+def make_nickname_markup_json(vip: bool, admin: bool, username: Union[str, None], user_id: int) -> str:
+    nickname = username if username else f"id{user_id}"
+    inline_btn_nickname = types.InlineKeyboardButton(
+        ('VIP' if vip else '') + ('ADMIN' if admin else '') + ' ' + nickname,
+        callback_data="user"
+    )
+    return types.InlineKeyboardMarkup().add(inline_btn_nickname).as_json()
+
+
+async def get_reply_map(message: types.Message) -> Union[dict, None]:
+    if not message.reply_to_message:
+        return None
+    reply_id = message.reply_to_message.message_id
+    if message.reply_to_message.from_user.is_bot:
+        sent_message = await db.sent_messages.find_one({"sender_message_id": reply_id},
+                                                       projection={"original_message_id": 1, "_id": 0})
+        if not sent_message:
+            return {}
+        reply_id = sent_message["original_message_id"]
+    cursor = db.sent_messages.find({"original_message_id": reply_id},
+                                   projection={"receiver_id": 1, "receiver_message_id": 1, "_id": 0})
+    return {doc["receiver_id"]: doc["receiver_message_id"] async for doc in cursor}
 
 
 async def delete_sent_messages(sender_id: int, sender_message_id: int) -> None:
     await db.sent_messages.delete_many({"sender_id": sender_id, "sender_message_id": sender_message_id})
 
 
-async def send_msg(message: types.Message, user, reply_markup):
+async def send_msg(message: types.Message, user, markup_json, reply_map=None) -> Union[dict, None]:
     try:
-        if message.reply_to_message:
-            if message.reply_to_message.from_user.is_bot:
-                reply_to_message_id = await get_sent_message_id(
-                    sender_message_id=message.reply_to_message.message_id,
-                    receiver_id=user["user_id"]
-                )
-            else:
-                reply_to_message_id = await get_sent_message_id(
-                    original_message_id=message.reply_to_message.message_id,
-                    receiver_id=user["user_id"]
-                )
-        else:
-            reply_to_message_id = None
-        sent_message = await bot.copy_message(chat_id=user["user_id"], from_chat_id=message.from_user.id,
-                                              message_id=message.message_id, reply_markup=reply_markup,
-                                              reply_to_message_id=reply_to_message_id)
-        await save_sent_message(message.from_user.id, sent_message.message_id, user["user_id"],
-                                sent_message.message_id, message.message_id)
+        reply_to_message_id = reply_map.get(user["user_id"]) if reply_map else None
+        payload = {"chat_id": user["user_id"], "from_chat_id": message.from_user.id,
+                   "message_id": message.message_id}
+        if markup_json:
+            payload["reply_markup"] = markup_json
+        if reply_to_message_id:
+            payload["reply_to_message_id"] = reply_to_message_id
+        async with send_semaphore:
+            try:
+                sent_message = await bot.request("copyMessage", payload)
+            except RetryAfter as e:
+                await asyncio.sleep(e.timeout)
+                sent_message = await bot.request("copyMessage", payload)
+        return {"sender_id": message.from_user.id, "sender_message_id": sent_message["message_id"],
+                "receiver_id": user["user_id"], "receiver_message_id": sent_message["message_id"],
+                "original_message_id": message.message_id}
     except BotBlocked:
-        await db.users.delete_one(dict(user_id=user["user_id"]))
+        await db.users.delete_one({"user_id": user["user_id"]})
     except UserDeactivated:
-        await db.users.delete_one(dict(user_id=user["user_id"]))
+        await db.users.delete_one({"user_id": user["user_id"]})
     except Exception as e:
         logging.exception(e)
+    return None
 
 
 async def broadcast_message(message: types.Message) -> None:
-    users = db.users.find()
-    user = User(**(await db.users.find_one({"user_id": message.from_user.id})))
-    settings = await get_settings(user.user_id)
-    show_nickname_inline = settings["show_nickname_inline"]
-    reply_markup = None
-    if show_nickname_inline:
-        nickname = message.from_user.username if message.from_user.username else "id" + str(message.from_user.id)
-        inline_btn_nickname = types.InlineKeyboardButton(
-            ('VIP' if user.vip else '') + ('ADMIN' if user.admin else '') + ' ' + nickname,
-            callback_data="user"
-        )
-        reply_markup = types.InlineKeyboardMarkup().add(inline_btn_nickname)
+    user = await fetch_user_cached(message.from_user.id)
+    markup_json = None
+    if user["show_nickname_inline"]:
+        markup_json = make_nickname_markup_json(user["vip"], user["admin"],
+                                                message.from_user.username, message.from_user.id)
+    reply_map = await get_reply_map(message)
     time_start = time.time()
-    cor = [asyncio.ensure_future(send_msg(message, user, reply_markup)) async for user in users]
-    count = len(cor)
-    await asyncio.gather(*cor)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=broadcast_queue_size)
+    docs = []
+    count = 0
+
+    async def producer():
+        nonlocal count
+        cursor = db.users.find(projection={"user_id": 1, "_id": 0}).batch_size(500)
+        async for receiver in cursor:
+            await queue.put(receiver)
+            count += 1
+        for _ in range(broadcast_workers):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            receiver = await queue.get()
+            if receiver is None:
+                return
+            doc = await send_msg(message, receiver, markup_json, reply_map)
+            if doc is not None:
+                docs.append(doc)
+                if len(docs) >= broadcast_window_size:
+                    batch = docs.copy()
+                    docs.clear()
+                    await flush_sent_messages(batch)
+
+    await asyncio.gather(producer(), *(worker() for _ in range(broadcast_workers)))
+    if docs:
+        await flush_sent_messages(docs)
     time_end = str(time.time() - time_start)[:5]
     await message.reply("<b>Ваше сообщение было отправлено {} пользователям за {} секунд!</b>".format(
         count, time_end
     ))
 
 
-async def edit_cor(message, sent_message, reply_markup):
+async def flush_sent_messages(docs: list) -> None:
+    await db.sent_messages.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+
+
+async def edit_cor(message, sent_message, markup_json):
     try:
-        await bot.edit_message_text(chat_id=sent_message["receiver_id"],
-                                    message_id=sent_message["receiver_message_id"],
-                                    text=f"{message.text} (edited)",
-                                    reply_markup=reply_markup)
+        payload = {"chat_id": sent_message["receiver_id"],
+                   "message_id": sent_message["receiver_message_id"],
+                   "text": f"{message.text} (edited)"}
+        if markup_json:
+            payload["reply_markup"] = markup_json
+        async with send_semaphore:
+            await bot.request("editMessageText", payload)
     except BotBlocked:
-        await db.users.delete_one(dict(user_id=sent_message["receiver_id"]))
+        await db.users.delete_one({"user_id": sent_message["receiver_id"]})
     except UserDeactivated:
-        await db.users.delete_one(dict(user_id=sent_message["receiver_id"]))
+        await db.users.delete_one({"user_id": sent_message["receiver_id"]})
     except Exception as e:
         logging.exception(e)
 
 
 @dp.edited_message_handler(content_types=types.ContentType.ANY)
 async def edit_handler(message: types.Message):
-    user = User(**(await db.users.find_one({"user_id": message.from_user.id})))
-    settings = await get_settings(user.user_id)
-    show_nickname_inline = settings["show_nickname_inline"]
-    reply_markup = None
-    if show_nickname_inline:
-        nickname = message.from_user.username if message.from_user.username else "id" + str(message.from_user.id)
-        inline_btn_nickname = types.InlineKeyboardButton(
-            ('VIP' if user.vip else '') + ('ADMIN' if user.admin else '') + ' ' + nickname,
-            callback_data="user"
-        )
-        reply_markup = types.InlineKeyboardMarkup().add(inline_btn_nickname)
+    user = await fetch_user_cached(message.from_user.id)
+    markup_json = None
+    if user["show_nickname_inline"]:
+        markup_json = make_nickname_markup_json(user["vip"], user["admin"],
+                                                message.from_user.username, message.from_user.id)
     sent_messages = await get_sent_messages(message.from_user.id, message.message_id)
-    await asyncio.gather(*[edit_cor(message, sent_message, reply_markup) for sent_message in sent_messages])
+    for start in range(0, len(sent_messages), broadcast_window_size):
+        window = sent_messages[start:start + broadcast_window_size]
+        await asyncio.gather(*[edit_cor(message, sent_message, markup_json) for sent_message in window])
+
+
+async def delete_cor(receiver_id: int, receiver_message_id: int) -> None:
+    try:
+        async with send_semaphore:
+            await bot.delete_message(receiver_id, receiver_message_id)
+    except Exception as e:
+        logging.exception(e)
 
 
 @dp.message_handler(Command('del'), is_reply=True)
 async def delete_handler(message: types.Message):
     if message.reply_to_message:
         if message.reply_to_message.from_user.is_bot:
-            msgs = db.sent_messages.find(dict(sender_message_id=message.reply_to_message.message_id))
+            sent_message = await db.sent_messages.find_one(
+                {"sender_message_id": message.reply_to_message.message_id},
+                projection={"sender_id": 1, "original_message_id": 1, "_id": 0})
         else:
-            msgs = db.sent_messages.find(dict(original_message_id=message.reply_to_message.message_id))
-        async for msg in msgs:
-            if not await is_admin(message.from_user.id) and not message.from_user.id == msg["sender_id"]:
+            sent_message = await db.sent_messages.find_one(
+                {"original_message_id": message.reply_to_message.message_id},
+                projection={"sender_id": 1, "original_message_id": 1, "_id": 0})
+        if sent_message:
+            if not await is_admin(message.from_user.id) and not message.from_user.id == sent_message["sender_id"]:
                 await message.reply("У вас нет прав для удаления сообщений.")
                 return
 
-            msg_check = db.sent_messages.find(dict(original_message_id=msg["original_message_id"]))
-
-            async for msg_need in msg_check:
-                try:
-                    await bot.delete_message(msg_need["receiver_id"], msg_need["receiver_message_id"])
-                except Exception as e:
-                    logging.exception(e)
+            original_message_id = sent_message["original_message_id"]
+            docs = await db.sent_messages.find(
+                {"original_message_id": original_message_id},
+                projection={"receiver_id": 1, "receiver_message_id": 1, "_id": 0}).to_list(None)
+            await asyncio.gather(*(delete_cor(doc["receiver_id"], doc["receiver_message_id"]) for doc in docs))
+            await db.sent_messages.delete_many({"original_message_id": original_message_id})
 
         await message.reply("Сообщение было удалено у всех пользователей.")
 
@@ -296,9 +347,11 @@ async def ban_handler(message: types.Message):
     user_id: int = 0
     if message.reply_to_message:
         if message.reply_to_message.from_user.is_bot:
-            msgs = db.sent_messages.find(dict(sender_message_id=message.reply_to_message.message_id))
+            msgs = db.sent_messages.find({"sender_message_id": message.reply_to_message.message_id},
+                                         projection={"sender_id": 1, "_id": 0})
         else:
-            msgs = db.sent_messages.find(dict(original_message_id=message.reply_to_message.message_id))
+            msgs = db.sent_messages.find({"original_message_id": message.reply_to_message.message_id},
+                                         projection={"sender_id": 1, "_id": 0})
         async for msg in msgs:
             if not await is_admin(message.from_user.id):
                 await message.reply("У вас нет прав для блокировки пользователя.")
@@ -309,13 +362,11 @@ async def ban_handler(message: types.Message):
             user = User(**(await db.users.find_one({"user_id": user_id})))
             if user:
                 if user.vip:
-                    await save_user(User(user_id=user_id), vip=False)
+                    await save_user(user_id, vip=False)
                 if user.admin:
-                    await save_user(User(user_id=user_id), admin=False)
+                    await save_user(user_id, admin=False)
 
-                await db.cooldown.update_one({"user_id": user_id},
-                                             {"$set": {"sent_at": datetime.now() + timedelta(days=365)}},
-                                             upsert=True)
+                await redis.set(f"cd:{user_id}", "1", px=ban_ms)
 
         if user_id:
             await message.reply("Пользователь был заблокирован!\nАйди: {}".format(user_id))
@@ -328,9 +379,11 @@ async def unban_handler(message: types.Message):
     user_id: int = 0
     if message.reply_to_message:
         if message.reply_to_message.from_user.is_bot:
-            msgs = db.sent_messages.find(dict(sender_message_id=message.reply_to_message.message_id))
+            msgs = db.sent_messages.find({"sender_message_id": message.reply_to_message.message_id},
+                                         projection={"sender_id": 1, "_id": 0})
         else:
-            msgs = db.sent_messages.find(dict(original_message_id=message.reply_to_message.message_id))
+            msgs = db.sent_messages.find({"original_message_id": message.reply_to_message.message_id},
+                                         projection={"sender_id": 1, "_id": 0})
         async for msg in msgs:
             if not await is_admin(message.from_user.id):
                 await message.reply("У вас нет прав для разблокировки пользователя.")
@@ -340,9 +393,7 @@ async def unban_handler(message: types.Message):
 
             user = User(**(await db.users.find_one({"user_id": user_id})))
             if user:
-                await db.cooldown.update_one({"user_id": user_id},
-                                             {"$set": {"sent_at": datetime.now() - timedelta(seconds=60)}},
-                                             upsert=True)
+                await redis.delete(f"cd:{user_id}")
 
         if user_id:
             await message.reply("Пользователь был разблокирован!\nАйди: {}".format(user_id))
@@ -353,16 +404,26 @@ async def unban_handler(message: types.Message):
 @dp.message_handler(content_types=[types.ContentType.ANY])
 async def text_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_admin(user_id) or await is_vip(user_id):
+    user = await fetch_user_cached(user_id)
+    if user["admin"] or user["vip"]:
         await broadcast_message(message)
-    elif await cooldown_check(user_id):
-        await update_cooldown(user_id)
+    elif await redis.set(f"cd:{user_id}", "1", nx=True, px=cooldown_ms):
         await broadcast_message(message)
     else:
         await message.reply('Пожалуйста, подождите 1 минуту перед отправкой следующего сообщения.')
 
 
+async def create_indexes() -> None:
+    await db.sent_messages.create_index([("sender_id", 1), ("original_message_id", 1)])
+    await db.sent_messages.create_index([("sender_message_id", 1), ("receiver_id", 1)])
+    await db.sent_messages.create_index([("original_message_id", 1), ("receiver_id", 1)])
+    await db.sent_messages.create_index([("sender_message_id", 1)])
+    await db.users.create_index("user_id", unique=True)
+    await db.settings.create_index("user_id", unique=True)
+
+
 async def on_startup(disp):
+    await create_indexes()
     await bot.send_message(chat_id=admin_id, text='Бот запущен')
     await disp.bot.set_my_commands(
         [BotCommand(command, description) for command, description in commands.items()]
@@ -373,9 +434,12 @@ async def on_shutdown(disp):
     await bot.send_message(chat_id=admin_id, text='Бот остановлен')
     await disp.storage.close()
     await disp.storage.wait_closed()
+    log_listener.stop()
 
 
 if __name__ == '__main__':
+    import uvloop
     from aiogram import executor
 
+    uvloop.install()
     executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)